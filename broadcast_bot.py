@@ -1,67 +1,250 @@
-import os, json, re, uuid
+import os, re, sys, time, heapq, asyncio, sqlite3, threading
+import orjson
+from collections import defaultdict
+from functools import lru_cache
+from html import escape
 from datetime import datetime, timedelta, timezone
 from typing import Dict, Any
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, constants
-from telegram.ext import Application, ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+from telegram.error import BadRequest, Forbidden
+from telegram.ext import AIORateLimiter, Application, ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
 
-STATE_FILE = os.getenv("STATE_FILE", "state.json")
+STATE_FILE = os.getenv("STATE_FILE", "state.json")  # старый JSON, только для миграции
+DB_FILE = os.getenv("DB_FILE") or os.path.splitext(STATE_FILE)[0] + ".db"
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 ADMIN_IDS = set(int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x)
 DEFAULT_TTL_MIN = int(os.getenv("DEFAULT_TTL_MIN", "15"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный https-адрес; пусто — long polling
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+PORT = int(os.getenv("PORT", "8443"))
+EDIT_DEBOUNCE_SEC = 1.1  # Telegram пропускает ~1 правку в секунду на чат
+SAVE_DEBOUNCE_SEC = 0.05
+SAVE_DEBOUNCE_MAX_SEC = 1.0
+SAVE_BUSY_PENDING = 100  # столько несохранённых изменений считаем всплеском
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+CHAT_GAP_SEC = 0.05  # сглаживает всплески запросов в один чат
+ARCHIVE_AFTER_SEC = int(float(os.getenv("ARCHIVE_AFTER_DAYS", "1")) * 86400)  # истёкшие заявки без финальной правки уходят в архив после этого
+ARCHIVE_KEEP_SEC = int(float(os.getenv("ARCHIVE_KEEP_DAYS", "30")) * 86400)  # архив старше этого удаляется
+ARCHIVE_EVERY_SEC = 3600
+_EDIT_GONE = ("message to edit not found", "message can't be edited", "message_id_invalid")  # повторять правку бессмысленно
+MAX_BROADCASTS = int(os.getenv("MAX_BROADCASTS", "500"))  # живые заявки сверх лимита закрываются досрочно, от самых старых
+_TEMPLATE = "📣 <b>Заявка #{sid}</b>\n{body}\n\n⏳ Актуально до: <b>{deadline}</b> (≈{ttl} мин)\n{status}"
+_TTL_RE = re.compile(r"^(?:ttl\s*=\s*)?(?P<num>\d{1,3})(?!\d)(?:\s*(?:min(?:utes?)?|мин(?:ут[аы]?)?|m)(?![^\W_]))?\s*(?P<rest>.*)$", re.IGNORECASE | re.DOTALL)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS broadcasts (bid TEXT PRIMARY KEY, json TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS messages (bid TEXT NOT NULL, chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, PRIMARY KEY (bid, chat_id));
+CREATE TABLE IF NOT EXISTS chats (chat_id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS admins (user_id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+CREATE TABLE IF NOT EXISTS archive (bid TEXT PRIMARY KEY, json TEXT NOT NULL);
+"""
+_db = None
+_state = None
+_pending: Dict[tuple, Any] = {}  # ("bc"|"msgs"|"archive", bid) / ("chat"|"chat_msgs", cid) / ("meta", key) / ("trim_archive", None) -> значение; повторные изменения склеиваются
+_dirty = asyncio.Event()
+_write_lock = threading.Lock()
+_save_lock = asyncio.Lock()
+_chat_sems: Dict[int, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(1))
+_send_sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)  # сколько запросов к Telegram в полёте одновременно
+_expirations: list = []  # куча (deadline_ts, bid)
+_expiry_event = asyncio.Event()
+
+def db() -> sqlite3.Connection:
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(DB_FILE, isolation_level=None, check_same_thread=False)
+        _db.execute("PRAGMA journal_mode=WAL"); _db.execute("PRAGMA synchronous=NORMAL")
+        _db.executescript(SCHEMA)
+        migrate_json_state(_db)
+    return _db
+
+def broadcast_row(bid: str, bc: Dict[str, Any]) -> tuple:
+    # ключи с "_" — производные кэши в памяти, в БД не пишем
+    return bid, orjson.dumps({k: v for k, v in bc.items() if k != "messages" and not k.startswith("_")}).decode()
+
+def migrate_json_state(con: sqlite3.Connection) -> None:
+    # разовый перенос старого state.json; после переноса файл переименовывается в .bak
+    if not os.path.exists(STATE_FILE): return
+    with open(STATE_FILE, "rb") as f:
+        try: data = orjson.loads(f.read())
+        except Exception: data = {}
+    broadcasts = data.get("broadcasts", {})
+    for bc in broadcasts.values():
+        if isinstance(bc.get("messages"), list): bc["messages"] = {m["chat_id"]: m["message_id"] for m in bc["messages"]}
+    with con:
+        con.execute("BEGIN")
+        con.executemany("INSERT OR IGNORE INTO admins VALUES (?)", [(uid,) for uid in data.get("admins", [])])
+        con.executemany("INSERT OR IGNORE INTO chats VALUES (?)", [(cid,) for cid in data.get("chats", [])])
+        con.executemany("INSERT OR REPLACE INTO broadcasts VALUES (?, ?)", [broadcast_row(bid, bc) for bid, bc in broadcasts.items()])
+        con.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?)",
+                        [(bid, cid, mid) for bid, bc in broadcasts.items() for cid, mid in bc.get("messages", {}).items()])
+    os.replace(STATE_FILE, STATE_FILE + ".bak")
+
+def read_state(con: sqlite3.Connection) -> Dict[str, Any]:
+    broadcasts = {bid: {**orjson.loads(raw), "messages": {}} for bid, raw in con.execute("SELECT bid, json FROM broadcasts ORDER BY json_extract(json, '$.created_at')")}
+    for bid, cid, mid in con.execute("SELECT bid, chat_id, message_id FROM messages"):
+        if bid in broadcasts: broadcasts[bid]["messages"][cid] = mid
+    admins = frozenset(uid for (uid,) in con.execute("SELECT user_id FROM admins")) | ADMIN_IDS
+    chats = {cid for (cid,) in con.execute("SELECT chat_id FROM chats")}
+    seq = con.execute("SELECT value FROM meta WHERE key = 'bid_seq'").fetchone()
+    return {"admins": admins, "chats": chats, "broadcasts": broadcasts, "bid_seq": seq[0] if seq else 0}
 
 def load_state() -> Dict[str, Any]:
-    if not os.path.exists(STATE_FILE):
-        return {"admins": list(ADMIN_IDS), "chats": [], "broadcasts": {}}
-    with open(STATE_FILE, "r", encoding="utf-8") as f:
-        try: data = json.load(f)
-        except Exception: data = {"admins": list(ADMIN_IDS), "chats": [], "broadcasts": {}}
-    data["admins"] = list(set(data.get("admins", [])) | ADMIN_IDS)
-    data.setdefault("chats", []); data.setdefault("broadcasts", {})
-    return data
-
-def save_state(state: Dict[str, Any]) -> None:
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
-
-def is_admin(uid: int, state: Dict[str, Any]) -> bool: return uid in set(state.get("admins", []))
-def short_id(bid: str) -> str: return bid.split("-")[0]
+    """Живое состояние в памяти: читается из БД один раз, дальше все обработчики работают с ним же."""
+    global _state
+    if _state is None: _state = read_state(db())
+    return _state
+
+def mark_dirty(key: tuple, value: Any = None) -> None:
+    _pending[key] = value; _dirty.set()
+
+def save_broadcast(state: Dict[str, Any], bid: str, messages: bool = False) -> None:
+    mark_dirty(("bc", bid))
+    if messages: mark_dirty(("msgs", bid))
+
+def evict_chats(state: Dict[str, Any], dead: set) -> None:
+    """Одним проходом убирает недоступные чаты из списка рассылки и из сообщений всех заявок."""
+    if not dead: return
+    state["chats"] -= dead
+    for bc in state["broadcasts"].values():
+        for cid in dead & bc["messages"].keys(): del bc["messages"][cid]
+    for cid in dead: mark_dirty(("chat", cid), False); mark_dirty(("chat_msgs", cid)); forget_chat(cid)
+
+def archive_broadcast(state: Dict[str, Any], bid: str) -> None:
+    # строка для архива снимается сразу: после pop заявки в состоянии уже нет; deadline_ts нужен чистке архива
+    bc = state["broadcasts"].pop(bid); deadline_ts(bc)
+    mark_dirty(("archive", bid), broadcast_row(bid, bc))
+
+async def cap_broadcasts(state: Dict[str, Any], context) -> None:
+    """Держит не больше MAX_BROADCASTS живых заявок: самые старые сверх лимита закрываются досрочно (партнёры увидят
+    «истёк срок» раньше указанного времени), в архив их уносит flush_broadcast_edits после финальной правки.
+    Истёкшие заявки не считаются: они и так уходят в архив."""
+    live = [bid for bid, bc in state["broadcasts"].items() if not bc.get("expired")]  # порядок вставки — от самых старых
+    for bid in live[:len(live) - MAX_BROADCASTS]:
+        state["broadcasts"][bid]["expired"] = True; save_broadcast(state, bid)
+        await update_broadcast_messages(context, bid)
+
+def add_chat(cid: int) -> None: mark_dirty(("chat", cid), True)
+def remove_chat(cid: int) -> None: mark_dirty(("chat", cid), False)
+
+def take_pending() -> list:
+    """Превращает накопленные изменения в SQL; вызывается в потоке event loop, пока состояние не меняется."""
+    broadcasts = _state["broadcasts"] if _state else {}; ops = []
+    for (kind, key), value in _pending.items():
+        if kind == "bc" and key in broadcasts:
+            ops.append(("INSERT OR REPLACE INTO broadcasts VALUES (?, ?)", [broadcast_row(key, broadcasts[key])]))
+        elif kind == "msgs" and key in broadcasts:
+            ops.append(("DELETE FROM messages WHERE bid = ?", [(key,)]))
+            ops.append(("INSERT INTO messages VALUES (?, ?, ?)", [(key, cid, mid) for cid, mid in broadcasts[key]["messages"].items()]))
+        elif kind == "chat":
+            ops.append(("INSERT OR IGNORE INTO chats VALUES (?)" if value else "DELETE FROM chats WHERE chat_id = ?", [(key,)]))
+        elif kind == "chat_msgs":
+            ops.append(("DELETE FROM messages WHERE chat_id = ?", [(key,)]))
+        elif kind == "meta":
+            ops.append(("INSERT OR REPLACE INTO meta VALUES (?, ?)", [(key, value)]))
+        elif kind == "archive":
+            ops.append(("INSERT OR REPLACE INTO archive VALUES (?, ?)", [value]))
+            ops.append(("DELETE FROM broadcasts WHERE bid = ?", [(key,)]))
+            ops.append(("DELETE FROM messages WHERE bid = ?", [(key,)]))
+        elif kind == "trim_archive":
+            ops.append(("DELETE FROM archive WHERE json_extract(json, '$.deadline_ts') < ?", [(value,)]))
+    _pending.clear()
+    return ops
+
+def write_ops(ops: list) -> None:
+    if not ops: return
+    con = db()
+    with _write_lock, con:
+        con.execute("BEGIN")
+        for sql, rows in ops: con.executemany(sql, rows)
+
+async def state_writer():
+    # фоновая запись: ждём изменений, даём им накопиться SAVE_DEBOUNCE_SEC и пишем одной транзакцией в отдельном потоке
+    while True:
+        await _dirty.wait(); await asyncio.sleep(SAVE_DEBOUNCE_SEC); waited = SAVE_DEBOUNCE_SEC
+        while len(_pending) >= SAVE_BUSY_PENDING and waited < SAVE_DEBOUNCE_MAX_SEC:  # под нагрузкой копим дольше
+            await asyncio.sleep(SAVE_DEBOUNCE_SEC); waited += SAVE_DEBOUNCE_SEC
+        _dirty.clear()
+        try: await save_now()
+        except Exception as e: print(f"ERROR: state write failed: {e}"); await asyncio.sleep(SAVE_DEBOUNCE_MAX_SEC)  # не крутим повтор вхолостую
+
+async def save_now():
+    """Сбрасывает накопленное сразу, минуя дебаунс; лок держит порядок транзакций, если параллельно пишет state_writer."""
+    async with _save_lock:
+        taken = dict(_pending)
+        try: await asyncio.to_thread(write_ops, take_pending())
+        except Exception:
+            # транзакция откатилась: возвращаем изменения в очередь, не затирая появившиеся за время записи
+            for key, value in taken.items(): _pending.setdefault(key, value)
+            _dirty.set(); raise
+
+def is_admin(uid: int, state: Dict[str, Any]) -> bool: return uid in state["admins"]
+def short_id(bid: str) -> str: return bid.split("-")[0]  # новые id уже короткие; UUID остались у старых заявок
+
+def base36(n: int) -> str:
+    out = ""
+    while True:
+        n, r = divmod(n, 36); out = "0123456789abcdefghijklmnopqrstuvwxyz"[r] + out
+        if not n: return out
+
+def next_bid(state: Dict[str, Any]) -> str:
+    """Короткий id заявки из счётчика: меньше callback_data и строк в БД, чем у UUID."""
+    state["bid_seq"] += 1; mark_dirty(("meta", "bid_seq"), state["bid_seq"])
+    return base36(state["bid_seq"])
 
 def build_keyboard(bid: str, state: Dict[str, Any]):
     bc = state["broadcasts"].get(bid)
     if not bc or bc.get("expired", False): return None
-    if not bc.get("claimed_by"):
-        return InlineKeyboardMarkup([[InlineKeyboardButton("✅ Взяddть", callback_data=f"claim:{bid}")]])
-    return InlineKeyboardMarkup([[InlineKeyboardButton("♻️ Снять", callback_data=f"unclaim:{bid}")]])
+    kbs = bc.get("_kb")
+    if kbs is None:  # оба варианта клавиатуры строим один раз на заявку и переиспользуем во всех правках
+        kbs = bc["_kb"] = {"free": InlineKeyboardMarkup([[InlineKeyboardButton("✅ Взяddть", callback_data=f"claim:{bid}")]]),
+                           "claimed": InlineKeyboardMarkup([[InlineKeyboardButton("♻️ Снять", callback_data=f"unclaim:{bid}")]])}
+    return kbs["claimed"] if bc.get("claimed_by") else kbs["free"]
+
+def human_name(u) -> str: return cached_human_name(u.id, u.first_name, u.last_name, u.username)
 
-def human_name(u) -> str:
-    parts = [p for p in [u.first_name, u.last_name] if p]
-    base = " ".join(parts) if parts else (u.username or f"id:{u.id}")
-    return f"{base} (@{u.username})" if u.username else base
+@lru_cache(maxsize=4096)  # ключ включает все поля имени, так что переименование само даёт новую запись
+def cached_human_name(uid: int, first_name, last_name, username) -> str:
+    parts = [p for p in [first_name, last_name] if p]
+    base = " ".join(parts) if parts else (username or f"id:{uid}")
+    return f"{base} (@{username})" if username else base
 
 def fmt_deadline(created_at_iso: str, ttl_min: int) -> str:
     created_dt = datetime.fromisoformat(created_at_iso)
     return (created_dt + timedelta(minutes=ttl_min)).strftime("%Y-%m-%d %H:%M")
 
+def deadline_ts(bc: Dict[str, Any]) -> int:
+    if "deadline_ts" not in bc:  # старые заявки: created_at хранится как наивное UTC-время
+        created = datetime.fromisoformat(bc["created_at"]).replace(tzinfo=timezone.utc)
+        bc["deadline_ts"] = int(created.timestamp()) + bc["ttl_min"] * 60
+    return bc["deadline_ts"]
+
+def render_hash(text: str, kb) -> int:
+    return hash((text, tuple(b.callback_data for row in kb.inline_keyboard for b in row) if kb else ()))
+
 def render_message(bid: str, state: Dict[str, Any]) -> str:
     bc = state["broadcasts"][bid]
+    # текст меняется только вместе со статусом, поэтому кэшируем по нему; ключ сам отражает смену состояния
+    key = (bool(bc.get("expired")), bc["claimed_by"]["name"] if bc.get("claimed_by") else None)
+    cache = bc.get("_render_cache")
+    if cache and cache[0] == key: return cache[1]
     status = (
         "🔴 Статус: истёк срок"
-        if bc.get("expired")
-        else ("🟡 Статус: взята — " + bc["claimed_by"]["name"] if bc.get("claimed_by") else "🟢 Статус: свободна")
-    )
-    deadline = fmt_deadline(bc["created_at"], bc["ttl_min"])
-    body = escape(bc["text"])  # важно: экранируем пользовательский текст, т.к. parse_mode=HTML
-    return (
-        f"📣 <b>Заявка #{short_id(bid)}</b>\n"
-        f"{body}\n\n"
-        f"⏳ Актуально до: <b>{deadline}</b> (≈{bc['ttl_min']} мин)\n"
-        f"{status}"
+        if key[0]
+        else ("🟡 Статус: взята — " + escape(key[1]) if key[1] is not None else "🟢 Статус: свободна")
     )
+    if "deadline_str" not in bc: bc["deadline_str"] = fmt_deadline(bc["created_at"], bc["ttl_min"])
+    # важно: пользовательский текст и имя экранируем, т.к. parse_mode=HTML; текст заявки не меняется — экранируем один раз
+    if "_body" not in bc: bc["_body"] = escape(bc["text"])
+    html = _TEMPLATE.format_map({"sid": short_id(bid), "body": bc["_body"], "deadline": bc["deadline_str"], "ttl": bc["ttl_min"], "status": status})
+    bc["_render_cache"] = (key, html)
+    return html
 
 
 def parse_broadcast_args(raw: str):
     raw = raw.strip()
-    m = re.match(r"^\s*(ttl\s*=\s*|\s*)(?P<num>\d{1,3})\s*(m|min|мин)?\s*(?P<rest>.*)$", raw, flags=re.IGNORECASE)
+    m = _TTL_RE.match(raw)
     ttl = None
     if m and m.group("num") and m.group("rest"):
         try:
@@ -94,7 +277,7 @@ async def register_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id, state): await update.message.reply_text("Только админы могут регистрировать чаты."); return
     cid = update.effective_chat.id
     if cid not in state["chats"]:
-        state["chats"].append(cid); save_state(state)
+        state["chats"].add(cid); add_chat(cid)
         await update.message.reply_text(f"Чат зарегистрирован: {update.effective_chat.title or cid}")
     else: await update.message.reply_text("Чат уже в списке.")
 
@@ -103,60 +286,133 @@ async def unregister_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id, state): await update.message.reply_text("Только админы могут убирать чаты."); return
     cid = update.effective_chat.id
     if cid in state["chats"]:
-        state["chats"].remove(cid); save_state(state)
+        state["chats"].discard(cid); remove_chat(cid); forget_chat(cid)
         await update.message.reply_text(f"Чат удалён: {update.effective_chat.title or cid}")
     else: await update.message.reply_text("Этого чата нет в списке.")
 
 async def list_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     state = load_state()
-    lines = [f"• {cid}" for cid in state["chats"]] or ["(пусто)"]
+    lines = [f"• {cid}" for cid in sorted(state["chats"])] or ["(пусто)"]
     await update.message.reply_text("Целевые чаты:\n" + "\n".join(lines))
 
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     state = load_state()
     if not is_admin(update.effective_user.id, state): await update.message.reply_text("Только админы могут рассылать заявки."); return
     if not state["chats"]: await update.message.reply_text("Нет зарегистрированных чатов. Добавьте бота в группы и отправьте /register."); return
-    raw = re.sub(r"^/broadcast(@\w+)?\s*", "", update.message.text or "", flags=re.IGNORECASE)
-    ttl_min, text = parse_broadcast_args(raw)
+    parts = (update.message.text or "").split(None, 1)  # первое слово — сама команда (/broadcast или /broadcast@Bot)
+    ttl_min, text = parse_broadcast_args(parts[1] if len(parts) > 1 else "")
     if not text: await update.message.reply_text("Формат: /broadcast <TTL мин> <текст>\nНапр.: /broadcast 12m Продаём дирхамы, Сбер, 150к."); return
-    bid = str(uuid.uuid4())
-    created_at = datetime.now(timezone.utc).replace(tzinfo=None).isoformat(timespec="seconds")
-    state["broadcasts"][bid] = {"text": text, "created_at": created_at, "ttl_min": ttl_min, "messages": [], "claimed_by": None, "expired": False}
-    save_state(state)
-    ok = fail = 0
-    for cid in list(state["chats"]):
-        try:
-            msg = await context.bot.send_message(chat_id=cid, text=render_message(bid, state),
-                                                 reply_markup=build_keyboard(bid, state),
-                                                 parse_mode=constants.ParseMode.HTML,
-                                                 disable_web_page_preview=True)
-            state["broadcasts"][bid]["messages"].append({"chat_id": cid, "message_id": msg.message_id}); ok += 1
-        except Exception: fail += 1
-    save_state(state)
-    await schedule_expiration(context, bid, ttl_min)
+    bid = next_bid(state)
+    now = datetime.now(timezone.utc)
+    created_at = now.replace(tzinfo=None).isoformat(timespec="seconds")
+    state["broadcasts"][bid] = {"text": text, "created_at": created_at, "ttl_min": ttl_min, "deadline_str": fmt_deadline(created_at, ttl_min),
+                                "deadline_ts": int(now.timestamp()) + ttl_min * 60,
+                                "messages": {}, "claimed_by": None, "expired": False}
+    await cap_broadcasts(state, context)
+    chats = tuple(state["chats"])
+    text_html, kb = render_message(bid, state), build_keyboard(bid, state)  # одинаковы для всех чатов
+    results = await asyncio.gather(*(in_chat(cid, context.bot.send_message, text=text_html, reply_markup=kb,
+                                             parse_mode=constants.ParseMode.HTML,
+                                             disable_web_page_preview=True) for cid in chats),
+                                   return_exceptions=True)
+    ok = fail = 0; dead = set()
+    for cid, res in zip(chats, results):
+        if isinstance(res, Forbidden): dead.add(cid)
+        if isinstance(res, Exception): fail += 1; continue
+        state["broadcasts"][bid]["messages"][cid] = res.message_id; ok += 1
+    state["broadcasts"][bid]["_shown"] = dict.fromkeys(state["broadcasts"][bid]["messages"], render_hash(text_html, kb))
+    save_broadcast(state, bid, messages=True); evict_chats(state, dead)
+    try: await save_now()  # ссылки на сообщения терять нельзя
+    except Exception as e: print(f"ERROR: state write failed: {e}")  # изменения остались в очереди, state_writer повторит
+    schedule_expiration(bid, state["broadcasts"][bid]["deadline_ts"])
     await update.message.reply_text(f"Рассылка завершена. Успешно: {ok}, ошибки: {fail}. Заявка #{short_id(bid)} (TTL {ttl_min} мин).")
 
-async def schedule_expiration(context: ContextTypes.DEFAULT_TYPE, bid: str, ttl_min: int):
-    context.job_queue.run_once(expire_job, when=timedelta(minutes=ttl_min), data={"bid": bid}, name=f"expire:{bid}")
+def forget_chat(cid: int) -> None:
+    sem = _chat_sems.get(cid)
+    if sem and not sem.locked(): del _chat_sems[cid]  # занятый семафор не трогаем, чтобы не нарушить очерёдность
+
+async def in_chat(cid: int, call, **kwargs):
+    """Не больше одного запроса к чату одновременно и в порядке постановки (лимит Telegram ~1 сообщение/с на чат);
+    разные чаты — параллельно."""
+    async with _chat_sems[cid]:
+        await asyncio.sleep(CHAT_GAP_SEC)
+        async with _send_sem: return await call(chat_id=cid, **kwargs)
+
+def schedule_expiration(bid: str, ts: int) -> None:
+    heapq.heappush(_expirations, (ts, bid)); _expiry_event.set()
+
+async def expiry_loop(app: Application):
+    # один таймер на все заявки: спим до ближайшего дедлайна из кучи или до появления новой заявки
+    while True:
+        if not _expirations:
+            await _expiry_event.wait(); _expiry_event.clear(); continue
+        wait = _expirations[0][0] - time.time()
+        if wait > 0:
+            try: await asyncio.wait_for(_expiry_event.wait(), wait)
+            except asyncio.TimeoutError: pass
+            _expiry_event.clear(); continue
+        _, bid = heapq.heappop(_expirations)
+        state = load_state(); bc = state["broadcasts"].get(bid)
+        if not bc or bc.get("expired"): continue
+        bc["expired"] = True; save_broadcast(state, bid)
+        await update_broadcast_messages(app, bid)
+
+async def update_broadcast_messages(context: ContextTypes.DEFAULT_TYPE, bid: str):
+    # склеиваем частые нажатия: не больше одной волны правок на заявку за EDIT_DEBOUNCE_SEC
+    pending = context.bot_data.setdefault("pending_edits", {})
+    bc = load_state()["broadcasts"].get(bid)
+    if bid in pending or not bc: return
+    pending[bid] = asyncio.create_task(flush_broadcast_edits(context, bid), name=f"edits:{bid}")
+    pending[bid].add_done_callback(log_task_error)
+
+def log_task_error(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception(): print(f"ERROR: {task.get_name()}: {task.exception()!r}")
 
-async def expire_job(ctx: ContextTypes.DEFAULT_TYPE):
-    bid = ctx.job.data["bid"]
+async def flush_broadcast_edits(context: ContextTypes.DEFAULT_TYPE, bid: str):
+    await asyncio.sleep(EDIT_DEBOUNCE_SEC)
+    context.bot_data["pending_edits"].pop(bid, None)
     state = load_state(); bc = state["broadcasts"].get(bid)
-    if not bc or bc.get("expired"): return
-    bc["expired"] = True; save_state(state)
-    for msg in bc.get("messages", []):
-        try:
-            await ctx.bot.edit_message_text(chat_id=msg["chat_id"], message_id=msg["message_id"],
-                                            text=render_message(bid, state),
-                                            parse_mode=constants.ParseMode.HTML,
-                                            disable_web_page_preview=True)
-        except Exception: pass
+    if not bc: return
+    inflight = context.bot_data.setdefault("inflight_edits", {}); me = asyncio.current_task()
+    prev = inflight.get(bid)
+    if prev and not prev.done(): prev.cancel()  # предыдущая волна устарела
+    text, kb = render_message(bid, state), build_keyboard(bid, state)
+    h = render_hash(text, kb); shown = bc.setdefault("_shown", {})
+    # правим только сообщения, которые ещё не показывают этот вариант (повторный клик, отменённая или частично упавшая волна)
+    targets = tuple((cid, mid) for cid, mid in bc["messages"].items() if shown.get(cid) != h); gone = set()
+
+    async def edit_one(cid: int, mid: int):
+        # до отправки сообщение считаем «неизвестно что показывающим»: правка могла дойти до Telegram, а волну отменили
+        # раньше ответа; тогда следующая волна всё равно его перепишет (повтор безопасен благодаря «not modified»)
+        shown.pop(cid, None)
+        try: await in_chat(cid, context.bot.edit_message_text, message_id=mid, text=text, reply_markup=kb,
+                           parse_mode=constants.ParseMode.HTML, disable_web_page_preview=True)
+        except BadRequest as e:
+            err = str(e).lower()
+            if any(s in err for s in _EDIT_GONE): gone.add(cid); return  # пост удалили или его нельзя править
+            if "not modified" not in err: raise  # после рестарта _shown пуст, а сообщение уже может показывать этот вариант
+        shown[cid] = h
+
+    if targets:
+        inflight[bid] = me
+        try: results = await asyncio.gather(*(edit_one(cid, mid) for cid, mid in targets), return_exceptions=True)
+        finally:
+            if inflight.get(bid) is me: del inflight[bid]
+        dead = {cid for (cid, _), res in zip(targets, results) if isinstance(res, Forbidden)}
+        evict_chats(state, dead); bc = state["broadcasts"].get(bid)  # заявку могли заархивировать, пока шла волна
+        if not bc: return
+        if gone:
+            for cid in gone & bc["messages"].keys(): del bc["messages"][cid]
+            mark_dirty(("msgs", bid))
+    # в архив — только когда финальную правку показывают все сообщения; иначе кнопки в части чатов остались бы живыми,
+    # а заявка осталась бы без повтора. Недошедшие правки повторит archive_loop.
+    if kb is None and all(shown.get(cid) == h for cid in bc["messages"]): archive_broadcast(state, bid)
 
 async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    state = load_state(); q = update.callback_query; await q.answer()
-    m = re.match(r"^(claim|unclaim):(.+)$", q.data or "")
-    if not m: return
-    action, bid = m.group(1), m.group(2)
+    # отвечаем на callback ровно один раз: либо ошибкой, либо пустым ack сразу после смены состояния
+    state = load_state(); q = update.callback_query
+    action, sep, bid = (q.data or "").partition(":")
+    if not sep or not bid or action not in ("claim", "unclaim"): await q.answer(); return
     bc = state["broadcasts"].get(bid)
     if not bc: await q.answer("Заявка не найдена.", show_alert=True); return
     if bc.get("expired"): await q.answer("Срок заявки истёк.", show_alert=True); return
@@ -171,22 +427,62 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if user.id != claimer.get("id") and not is_admin(user.id, state):
             await q.answer("Снять может только исполнитель или админ.", show_alert=True); return
         bc["claimed_by"] = None
-    save_state(state)
-    kb = build_keyboard(bid, state)
-    for msg in bc.get("messages", []):
-        try:
-            await context.bot.edit_message_text(chat_id=msg["chat_id"], message_id=msg["message_id"],
-                                                text=render_message(bid, state), reply_markup=kb,
-                                                parse_mode=constants.ParseMode.HTML,
-                                                disable_web_page_preview=True)
-        except Exception: pass
+    save_broadcast(state, bid)
+    await update_broadcast_messages(context, bid)
+    await q.answer()
 
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Неизвестная команда. Наберите /help.")
 
+def archive_old_broadcasts(state: Dict[str, Any]) -> None:
+    """Истёкшие заявки, чью финальную правку archive_loop так и не смог разослать за ARCHIVE_AFTER_SEC, всё равно уходят в архив; плюс чистка старого архива."""
+    cutoff = time.time() - ARCHIVE_AFTER_SEC
+    old = [bid for bid, bc in state["broadcasts"].items() if bc.get("expired") and deadline_ts(bc) < cutoff]
+    for bid in old: archive_broadcast(state, bid)
+    mark_dirty(("trim_archive", None), time.time() - ARCHIVE_KEEP_SEC)
+
+async def archive_loop(app: Application):
+    while True:
+        await asyncio.sleep(ARCHIVE_EVERY_SEC); state = load_state(); archive_old_broadcasts(state)
+        for bid in [bid for bid, bc in state["broadcasts"].items() if bc.get("expired")]:
+            await update_broadcast_messages(app, bid)  # повтор финальной правки там, где она не дошла
+
+async def post_init(app: Application):
+    # один проход: просроченные за время простоя помечаем сразу, остальные одной пачкой кладём в кучу
+    state = await asyncio.to_thread(load_state); archive_old_broadcasts(state); now = time.time(); due = []
+    for bid, bc in state["broadcasts"].items():
+        if bc.get("expired"): due.append(bid)  # истёкшая заявка в состоянии — значит, финальная правка дошла не везде
+        elif deadline_ts(bc) <= now: bc["expired"] = True; save_broadcast(state, bid); due.append(bid)
+        else: _expirations.append((deadline_ts(bc), bid))
+    heapq.heapify(_expirations); _expiry_event.set()
+    for bid in due: await update_broadcast_messages(app, bid)
+    await cap_broadcasts(state, app)  # после пометки просроченных, чтобы досрочно закрывать только действительно живые
+    app.bot_data["tasks"] = [asyncio.create_task(state_writer()), asyncio.create_task(expiry_loop(app)),
+                             asyncio.create_task(archive_loop(app))]
+
+async def post_shutdown(app: Application):
+    writer, *others = app.bot_data["tasks"]
+    for task in others: task.cancel()
+    await save_now(); writer.cancel()  # save_now дождётся текущей записи writer'а, порядок транзакций сохраняется
+
+def export_json() -> None:
+    """Отладка: печатает состояние из БД как читаемый JSON (python broadcast_bot.py --export-json).
+    БД открывается только на чтение и без миграции, чтобы дамп ничего не менял на диске."""
+    try:
+        con = sqlite3.connect(f"file:{DB_FILE}?mode=ro", uri=True)
+        state = read_state(con); con.close()
+    except sqlite3.Error as e: print(f"ERROR: cannot read {DB_FILE}: {e}"); return
+    out = {"admins": sorted(state["admins"]), "chats": sorted(state["chats"]), "bid_seq": state["bid_seq"],
+           "broadcasts": {bid: {k: v for k, v in bc.items() if not k.startswith("_")} for bid, bc in state["broadcasts"].items()}}
+    sys.stdout.buffer.write(orjson.dumps(out, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS) + b"\n")
+
 def main():
+    if "--export-json" in sys.argv[1:]: export_json(); return
     if not BOT_TOKEN: print("ERROR: BOT_TOKEN is not set."); return
-    app: Application = ApplicationBuilder().token(BOT_TOKEN).build()
+    app: Application = (ApplicationBuilder().token(BOT_TOKEN)
+                        .rate_limiter(AIORateLimiter(overall_max_rate=30, group_max_rate=20, max_retries=3))
+                        .connection_pool_size(max(100, BROADCAST_CONCURRENCY)).pool_timeout(20).connect_timeout(10).read_timeout(20)
+                        .post_init(post_init).post_shutdown(post_shutdown).build())
     app.add_handler(CommandHandler(["start","help"], start))
     app.add_handler(CommandHandler("register", register_chat))
     app.add_handler(CommandHandler("unregister", unregister_chat))
@@ -195,7 +491,10 @@ def main():
     app.add_handler(CallbackQueryHandler(on_callback))
     app.add_handler(MessageHandler(filters.COMMAND, unknown))
     print("Bot is running...")
-    app.run_polling()
+    if WEBHOOK_URL and not os.getenv("USE_POLLING"):
+        app.run_webhook(listen="0.0.0.0", port=PORT, url_path=BOT_TOKEN,
+                        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{BOT_TOKEN}", secret_token=WEBHOOK_SECRET)
+    else: app.run_polling()
 
 if __name__ == "__main__":
     main()